@@ -10,9 +10,12 @@ This script tests PostgreSQL replication by:
 """
 
 import argparse
+import base64
+import io
 from pathlib import Path
 import random
-import string
+import threading
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 import os
@@ -29,6 +32,27 @@ try:
 except ImportError:
     DOTENV_AVAILABLE = False
 
+# Batch size above which write_data switches from INSERT to COPY
+_COPY_THRESHOLD = 5000
+
+
+def _generate_payload_rows(num_records: int) -> List[Tuple[str, int]]:
+    """Generate all (test_data, random_value) rows from one urandom read.
+
+    A single kernel entropy read plus base64 slicing is roughly an order
+    of magnitude cheaper per row than driving random.choices() over an
+    alphabet, and keeps payload generation entirely out of the DB path.
+    """
+    # 42 bytes per row: 38 base64-encode to 50+ chars, 4 feed random_value
+    raw = os.urandom(42 * num_records)
+    rows = []
+    for i in range(num_records):
+        chunk = raw[i * 42:(i + 1) * 42]
+        test_data = base64.b64encode(chunk[:38]).decode('ascii')[:50]
+        random_value = int.from_bytes(chunk[38:], 'big') % 1000000 + 1
+        rows.append((test_data, random_value))
+    return rows
+
 
 @dataclass
 class DatabaseConfig:
@@ -49,14 +73,20 @@ class ReplicationTester:
         self.replica_configs = replica_configs
         self.primary_pool = None
         self.replica_pools = []
+        # Per-replica semaphores capping in-flight readers at pool size
+        self.replica_semaphores = {}
         
     def setup_connections(self):
         """Initialize connection pools"""
         print("Setting up database connection pools...")
-        
-        # Primary connection pool
-        self.primary_pool = psycopg2.pool.SimpleConnectionPool(
-            1, 10,
+
+        # Size pools so concurrent readers never block on getconn:
+        # one connection per replica worker plus some headroom
+        maxconn = max(10, len(self.replica_configs) + 2)
+
+        # Primary connection pool (thread-safe for concurrent checkout)
+        self.primary_pool = psycopg2.pool.ThreadedConnectionPool(
+            1, maxconn,
             host=self.primary_config.host,
             port=self.primary_config.port,
             database=self.primary_config.database,
@@ -64,11 +94,11 @@ class ReplicationTester:
             password=self.primary_config.password
         )
         print(f"✓ Primary pool created: {self.primary_config.host}")
-        
+
         # Replica connection pools
         for replica_config in self.replica_configs:
-            replica_pool = psycopg2.pool.SimpleConnectionPool(
-                1, 10,
+            replica_pool = psycopg2.pool.ThreadedConnectionPool(
+                1, maxconn,
                 host=replica_config.host,
                 port=replica_config.port,
                 database=replica_config.database,
@@ -76,6 +106,7 @@ class ReplicationTester:
                 password=replica_config.password
             )
             self.replica_pools.append((replica_config, replica_pool))
+            self.replica_semaphores[replica_config.host] = threading.BoundedSemaphore(maxconn)
             print(f"✓ Replica pool created: {replica_config.host}")
     
     def close_connections(self):
@@ -106,17 +137,35 @@ class ReplicationTester:
                     );
                 """)
                 
-                # Create index for better performance
+                conn.commit()
+                print("✓ Test table 'replication_test' created successfully")
+        except Exception as e:
+            conn.rollback()
+            print(f"✗ Error creating schema: {e}")
+            raise
+        finally:
+            self.primary_pool.putconn(conn)
+
+    def build_indexes(self):
+        """Create secondary indexes after the bulk load
+
+        Building the index once over the loaded table is a single
+        sort-based build instead of an incremental update per INSERT.
+        """
+        print("\nBuilding indexes...")
+
+        conn = self.primary_pool.getconn()
+        try:
+            with conn.cursor() as cur:
                 cur.execute("""
-                    CREATE INDEX idx_replication_test_created_at 
+                    CREATE INDEX idx_replication_test_created_at
                     ON replication_test(created_at);
                 """)
-                
                 conn.commit()
-                print("✓ Test table 'replication_test' created successfully")
+                print("✓ Index 'idx_replication_test_created_at' created")
         except Exception as e:
             conn.rollback()
-            print(f"✗ Error creating schema: {e}")
+            print(f"✗ Error building indexes: {e}")
             raise
         finally:
             self.primary_pool.putconn(conn)
@@ -129,21 +178,21 @@ class ReplicationTester:
         for replica_config, replica_pool in self.replica_pools:
             conn = replica_pool.getconn()
             try:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                with conn.cursor() as cur:
                     # Check if database is in recovery mode
-                    cur.execute("SELECT pg_is_in_recovery() as in_recovery;")
+                    cur.execute("SELECT pg_is_in_recovery();")
                     result = cur.fetchone()
-                    
-                    if result['in_recovery']:
+
+                    if result[0]:
                         print(f"✓ {replica_config.host} is in recovery mode (replica)")
-                        
+
                         # Get replication lag
                         cur.execute("""
-                            SELECT EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp())) 
+                            SELECT EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp()))
                             AS lag_seconds;
                         """)
                         lag_result = cur.fetchone()
-                        lag = lag_result['lag_seconds'] if lag_result['lag_seconds'] else 0
+                        lag = lag_result[0] if lag_result[0] else 0
                         print(f"  Replication lag: {lag:.2f} seconds")
                     else:
                         print(f"✗ {replica_config.host} is NOT in recovery mode!")
@@ -156,31 +205,60 @@ class ReplicationTester:
         
         return all_valid
     
-    def write_data(self, num_records: int) -> List[int]:
-        """Write test data to primary database"""
+    def write_data(self, num_records: int, unsafe_fast_writes: bool = False) -> List[int]:
+        """Write test data to primary database
+
+        With unsafe_fast_writes the session commits with
+        synchronous_commit = off, skipping the WAL fsync wait. That is
+        test-only behaviour: writes can be lost on a crash and the lag
+        numbers no longer reflect durably committed transactions.
+        """
         print(f"\nWriting {num_records} records to primary database...")
         
         conn = self.primary_pool.getconn()
         inserted_ids = []
-        
+
+        # Pre-generate all payloads so the insert itself is a pure I/O operation
+        rows = _generate_payload_rows(num_records)
+
         try:
             with conn.cursor() as cur:
-                for i in range(num_records):
-                    test_data = ''.join(random.choices(string.ascii_letters + string.digits, k=50))
-                    random_value = random.randint(1, 1000000)
-                    
+                if unsafe_fast_writes:
+                    cur.execute("SET synchronous_commit = off;")
+                    print("⚠ synchronous_commit disabled for this session (unsafe)")
+
+                if num_records >= _COPY_THRESHOLD:
+                    # COPY skips per-row SQL parsing entirely and streams the
+                    # batch in a single protocol frame; since COPY has no
+                    # RETURNING, recover the ids from the serial range instead
+                    cur.execute("SELECT COALESCE(MAX(id), 0) FROM replication_test;")
+                    last_id = cur.fetchone()[0]
+
+                    buf = io.StringIO()
+                    for test_data, random_value in rows:
+                        buf.write(f"{test_data}\t{random_value}\n")
+                    buf.seek(0)
+                    cur.copy_from(buf, 'replication_test',
+                                  columns=('test_data', 'random_value'))
+
+                    cur.execute("""
+                        SELECT id FROM replication_test
+                        WHERE id > %s ORDER BY id;
+                    """, (last_id,))
+                    inserted_ids = [row[0] for row in cur.fetchall()]
+                else:
+                    # Two parallel arrays unnested server-side: one protocol
+                    # message, one planner pass, ids streamed back in a single
+                    # result set (no per-page VALUES lists to parse)
+                    test_datas = [row[0] for row in rows]
+                    random_values = [row[1] for row in rows]
                     cur.execute("""
                         INSERT INTO replication_test (test_data, random_value)
-                        VALUES (%s, %s)
+                        SELECT * FROM unnest(%s::text[], %s::int[])
                         RETURNING id;
-                    """, (test_data, random_value))
-                    
-                    inserted_id = cur.fetchone()[0]
-                    inserted_ids.append(inserted_id)
-                    
-                    if (i + 1) % 100 == 0:
-                        print(f"  Written {i + 1}/{num_records} records...")
-                
+                    """, (test_datas, random_values))
+                    inserted_ids = [row[0] for row in cur.fetchall()]
+
                 conn.commit()
                 print(f"✓ Successfully wrote {num_records} records")
         except Exception as e:
@@ -195,26 +273,29 @@ class ReplicationTester:
     def read_from_replica(self, replica_config: DatabaseConfig, replica_pool, 
                          record_ids: List[int]) -> Tuple[str, int, float]:
         """Read data from a specific replica"""
-        conn = replica_pool.getconn()
         successful_reads = 0
         start_time = time.time()
-        
-        try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                for record_id in record_ids:
-                    cur.execute("""
-                        SELECT id, test_data, random_value, created_at
-                        FROM replication_test
-                        WHERE id = %s;
-                    """, (record_id,))
-                    
-                    result = cur.fetchone()
-                    if result:
-                        successful_reads += 1
-        except Exception as e:
-            print(f"✗ Error reading from {replica_config.host}: {e}")
-        finally:
-            replica_pool.putconn(conn)
+
+        # Queue here rather than blocking inside getconn if more workers than
+        # pooled connections ever target the same replica
+        with self.replica_semaphores[replica_config.host]:
+            conn = replica_pool.getconn()
+            try:
+                with conn.cursor() as cur:
+                    # Fetch ids in pages of 1000 with a single ANY() query per
+                    # page instead of one round-trip per id
+                    for offset in range(0, len(record_ids), 1000):
+                        chunk = record_ids[offset:offset + 1000]
+                        cur.execute("""
+                            SELECT id, test_data, random_value, created_at
+                            FROM replication_test
+                            WHERE id = ANY(%s);
+                        """, (chunk,))
+                        successful_reads += cur.rowcount
+            except Exception as e:
+                print(f"✗ Error reading from {replica_config.host}: {e}")
+            finally:
+                replica_pool.putconn(conn)
         
         elapsed_time = time.time() - start_time
         return replica_config.host, successful_reads, elapsed_time
@@ -223,35 +304,51 @@ class ReplicationTester:
         """Perform concurrent reads from all replicas"""
         print(f"\nPerforming {num_operations} concurrent read operations across replicas...")
         
-        # Distribute reads across replicas
-        reads_per_replica = num_operations // len(self.replica_pools)
-        results = {}
-        
-        with ThreadPoolExecutor(max_workers=len(self.replica_pools)) as executor:
+        # Distribute reads across replicas, spreading the remainder so the
+        # executed read count matches num_operations exactly
+        num_replicas = len(self.replica_pools)
+        remainder = num_operations % num_replicas
+        per_replica = [num_operations // num_replicas + (1 if i < remainder else 0)
+                       for i in range(num_replicas)]
+        results = defaultdict(lambda: {'successful_reads': 0, 'elapsed_time': 0.0})
+
+        # One worker per pooled connection so each replica serves its pool's
+        # worth of parallel readers instead of a single thread
+        max_workers = sum(pool.maxconn for _, pool in self.replica_pools)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
             futures = []
-            
-            for replica_config, replica_pool in self.replica_pools:
+
+            for i, (replica_config, replica_pool) in enumerate(self.replica_pools):
                 # Randomly select records to read
-                selected_ids = random.choices(record_ids, k=reads_per_replica)
-                future = executor.submit(
-                    self.read_from_replica,
-                    replica_config,
-                    replica_pool,
-                    selected_ids
-                )
-                futures.append(future)
-            
+                selected_ids = random.choices(record_ids, k=per_replica[i])
+
+                # Shard this replica's ids across its pooled connections
+                shard_size = max(1, -(-len(selected_ids) // replica_pool.maxconn))
+                for offset in range(0, len(selected_ids), shard_size):
+                    futures.append(executor.submit(
+                        self.read_from_replica,
+                        replica_config,
+                        replica_pool,
+                        selected_ids[offset:offset + shard_size]
+                    ))
+
+            # Aggregation stays on this thread (as_completed drains futures
+            # serially), so no extra lock is needed around the defaultdict
             for future in as_completed(futures):
                 host, successful_reads, elapsed_time = future.result()
-                results[host] = {
-                    'successful_reads': successful_reads,
-                    'elapsed_time': elapsed_time,
-                    'reads_per_second': successful_reads / elapsed_time if elapsed_time > 0 else 0
-                }
-                print(f"✓ {host}: {successful_reads} reads in {elapsed_time:.2f}s "
-                      f"({results[host]['reads_per_second']:.2f} reads/s)")
-        
-        return results
+                stats = results[host]
+                stats['successful_reads'] += successful_reads
+                # Shards run in parallel, so the slowest one bounds wall time
+                stats['elapsed_time'] = max(stats['elapsed_time'], elapsed_time)
+
+        for host, stats in results.items():
+            stats['reads_per_second'] = (stats['successful_reads'] / stats['elapsed_time']
+                                         if stats['elapsed_time'] > 0 else 0)
+            print(f"✓ {host}: {stats['successful_reads']} reads in {stats['elapsed_time']:.2f}s "
+                  f"({stats['reads_per_second']:.2f} reads/s)")
+
+        return dict(results)
     
     def verify_data_consistency(self, record_ids: List[int]) -> bool:
         """Verify that data is consistent across primary and replicas"""
@@ -259,25 +356,22 @@ class ReplicationTester:
         
         # Get data from primary
         primary_conn = self.primary_pool.getconn()
-        primary_data = {}
-        
+
         try:
             with primary_conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute("""
                     SELECT id, test_data, random_value
                     FROM replication_test
-                    WHERE id = ANY(%s)
-                    ORDER BY id;
+                    WHERE id = ANY(%s);
                 """, (record_ids[:10],))  # Check first 10 records
-                
-                for row in cur.fetchall():
-                    primary_data[row['id']] = {
-                        'test_data': row['test_data'],
-                        'random_value': row['random_value']
-                    }
+
+                primary_set = {(row['id'], row['test_data'], row['random_value'])
+                               for row in cur.fetchall()}
         finally:
             self.primary_pool.putconn(primary_conn)
-        
+
+        primary_ids = [record_id for record_id, _, _ in primary_set]
+
         # Compare with each replica
         all_consistent = True
         for replica_config, replica_pool in self.replica_pools:
@@ -287,41 +381,27 @@ class ReplicationTester:
                     cur.execute("""
                         SELECT id, test_data, random_value
                         FROM replication_test
-                        WHERE id = ANY(%s)
-                        ORDER BY id;
-                    """, (list(primary_data.keys()),))
-                    
-                    replica_data = {row['id']: row for row in cur.fetchall()}
-                    
-                    # Compare data
-                    if len(replica_data) != len(primary_data):
-                        print(f"✗ {replica_config.host}: Record count mismatch "
-                              f"(expected {len(primary_data)}, got {len(replica_data)})")
-                        all_consistent = False
-                        continue
-                    
-                    mismatches = 0
-                    for record_id, primary_record in primary_data.items():
-                        if record_id not in replica_data:
-                            mismatches += 1
-                            continue
-                        
-                        replica_record = replica_data[record_id]
-                        if (primary_record['test_data'] != replica_record['test_data'] or
-                            primary_record['random_value'] != replica_record['random_value']):
-                            mismatches += 1
-                    
-                    if mismatches > 0:
-                        print(f"✗ {replica_config.host}: {mismatches} data mismatches found")
-                        all_consistent = False
-                    else:
-                        print(f"✓ {replica_config.host}: Data is consistent")
+                        WHERE id = ANY(%s);
+                    """, (primary_ids,))
+
+                    replica_set = {(row['id'], row['test_data'], row['random_value'])
+                                   for row in cur.fetchall()}
+
+                # One C-level set difference covers missing rows and field
+                # mismatches alike, instead of per-row dict lookups
+                missing = primary_set - replica_set
+                if missing:
+                    print(f"✗ {replica_config.host}: {len(missing)} data mismatches found")
+                    all_consistent = False
+                else:
+                    print(f"✓ {replica_config.host}: Data is consistent")
             finally:
                 replica_pool.putconn(conn)
-        
+
         return all_consistent
     
-    def run_full_test(self, num_writes: int, num_reads: int, wait_for_replication: int = 2):
+    def run_full_test(self, num_writes: int, num_reads: int, wait_for_replication: int = 2,
+                      unsafe_fast_writes: bool = False):
         """Run complete replication test"""
         print("=" * 70)
         print("DATABASE REPLICATION TEST")
@@ -344,9 +424,10 @@ class ReplicationTester:
                 if response.lower() != 'y':
                     return
             
-            # Write data
-            record_ids = self.write_data(num_writes)
-            
+            # Write data, then index it (cheaper than indexing during the load)
+            record_ids = self.write_data(num_writes, unsafe_fast_writes)
+            self.build_indexes()
+
             # Wait for replication
             print(f"\nWaiting {wait_for_replication} seconds for replication to propagate...")
             time.sleep(wait_for_replication)
@@ -472,7 +553,15 @@ def main():
         default=2,
         help='Seconds to wait for replication after writes (default: 2)'
     )
-    
+
+    parser.add_argument(
+        '--unsafe-fast-writes',
+        action='store_true',
+        help='Write with synchronous_commit=off (test-only: skips the WAL '
+             'fsync wait, so crashes can lose writes and lag numbers are '
+             'less realistic)'
+    )
+
     args = parser.parse_args()
     
     try:
@@ -481,7 +570,8 @@ def main():
         
         # Run test
         tester = ReplicationTester(primary_config, replica_configs)
-        tester.run_full_test(args.writes, args.reads, args.wait)
+        tester.run_full_test(args.writes, args.reads, args.wait,
+                             unsafe_fast_writes=args.unsafe_fast_writes)
         
     except Exception as e:
         print(f"Error: {e}")
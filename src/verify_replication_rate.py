@@ -6,12 +6,14 @@ This script measures the time it takes for data written to the primary database
 to be replicated to the read replicas.
 """
 
+import select
 import time
 import uuid
 import statistics
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Optional
 import psycopg2
+import psycopg2.pool
 
 # Import configuration from existing test script
 from test_replication import load_config_from_env, DatabaseConfig
@@ -21,7 +23,14 @@ class ReplicationRateVerifier:
         self.primary_config = primary_config
         self.replica_configs = replica_configs
         self.primary_conn = None
-        self.replica_conns = []
+        self._primary_cur = None
+        self.replica_pools = []
+        # Connections (by id) that already have the poll statement prepared
+        self._prepared_conns = set()
+        # Connections (by id) that successfully LISTEN for insert notifications
+        self._listening_conns = set()
+        # Connections (by id) where a LISTEN has been attempted at all
+        self._listen_attempted = set()
 
     def setup_connections(self):
         """Establish connections to all databases"""
@@ -35,61 +44,184 @@ class ReplicationRateVerifier:
                 user=self.primary_config.user,
                 password=self.primary_config.password
             )
+            # One cursor for all lag samples instead of one per sample
+            self._primary_cur = self.primary_conn.cursor()
             print(f"✓ Connected to Primary: {self.primary_config.host}")
             
-            # Connect to replicas
+            # Pool the replicas so several samples can poll concurrently
             for config in self.replica_configs:
-                conn = psycopg2.connect(
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    1, 4,
                     host=config.host,
                     port=config.port,
                     database=config.database,
                     user=config.user,
                     password=config.password
                 )
-                self.replica_conns.append((config, conn))
-                print(f"✓ Connected to Replica: {config.host}")
-                
+                self.replica_pools.append((config, pool))
+                print(f"✓ Replica pool created: {config.host}")
+
+            self._ensure_notify_trigger()
+
         except Exception as e:
             print(f"✗ Connection error: {e}")
             self.close_connections()
             raise
 
+    def _start_listening(self, replica_conn) -> bool:
+        """Try to LISTEN for insert notifications on a replica connection.
+
+        NOTIFY does not propagate over physical streaming replication and
+        hot standbys reject LISTEN outright, so on the default setup this
+        fails and _wait_for_replica keeps its polling loop. It succeeds on
+        logical-replication or single-node setups, where it replaces the
+        50ms poll granularity with sub-ms event delivery.
+        """
+        try:
+            replica_conn.autocommit = True
+            with replica_conn.cursor() as cur:
+                cur.execute("LISTEN replication_test_insert;")
+            self._listening_conns.add(id(replica_conn))
+            return True
+        except Exception:
+            replica_conn.rollback()
+            return False
+
+    def _ensure_notify_trigger(self):
+        """Install an insert trigger on the primary that broadcasts the
+        test_data payload on the 'replication_test_insert' channel."""
+        try:
+            with self.primary_conn.cursor() as cur:
+                cur.execute("""
+                    CREATE OR REPLACE FUNCTION notify_replication_test_insert()
+                    RETURNS trigger AS $$
+                    BEGIN
+                        PERFORM pg_notify('replication_test_insert', NEW.test_data);
+                        RETURN NEW;
+                    END;
+                    $$ LANGUAGE plpgsql;
+                """)
+                cur.execute("""
+                    DROP TRIGGER IF EXISTS replication_test_notify ON replication_test;
+                    CREATE TRIGGER replication_test_notify
+                    AFTER INSERT ON replication_test
+                    FOR EACH ROW EXECUTE FUNCTION notify_replication_test_insert();
+                """)
+                self.primary_conn.commit()
+        except Exception as e:
+            self.primary_conn.rollback()
+            print(f"⚠ Could not install notify trigger (polling only): {e}")
+
     def close_connections(self):
         """Close all active connections"""
+        if self._primary_cur and not self._primary_cur.closed:
+            self._primary_cur.close()
         if self.primary_conn:
             self.primary_conn.close()
-        for _, conn in self.replica_conns:
-            conn.close()
+        for _, pool in self.replica_pools:
+            pool.closeall()
         print("Connections closed.")
 
-    def _wait_for_replica(self, replica_config: DatabaseConfig, replica_conn, target_uuid: str) -> Optional[float]:
-        """Poll a single replica until the target UUID is found"""
+    def _wait_for_replica(self, replica_config: DatabaseConfig, replica_pool, target_uuid: str,
+                          target_lsn: Optional[str] = None) -> Optional[float]:
+        """Wait for a single replica to catch up to the primary's insert.
+
+        Prefers byte-level WAL tracking (pg_last_wal_replay_lsn vs the
+        primary's insert LSN), which removes the poll-interval floor and
+        the row-SELECT cost from the measurement; falls back to polling
+        for the target UUID row when no LSN is available.
+        """
+        replica_conn = replica_pool.getconn()
+        # Autocommit avoids an implicit BEGIN (and snapshot acquisition on
+        # the standby backend) for every poll tick
+        replica_conn.autocommit = True
+        try:
+            return self._poll_replica(replica_config, replica_conn, target_uuid, target_lsn)
+        finally:
+            replica_pool.putconn(replica_conn)
+
+    def _poll_replica(self, replica_config: DatabaseConfig, replica_conn, target_uuid: str,
+                      target_lsn: Optional[str]) -> Optional[float]:
+        """Poll one checked-out replica connection until caught up"""
         start_time = time.time()
         timeout = 10.0  # Timeout in seconds
-        
-        while time.time() - start_time < timeout:
+
+        use_row_poll = target_lsn is None
+        if not use_row_poll:
             try:
                 with replica_conn.cursor() as cur:
+                    while time.time() - start_time < timeout:
+                        cur.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn", (target_lsn,))
+                        caught_up = cur.fetchone()[0]
+                        if caught_up:
+                            return time.time()
+                        if caught_up is None:
+                            # Not a hot standby; fall back to row polling
+                            use_row_poll = True
+                            break
+                        time.sleep(0.001)
+            except Exception as e:
+                print(f"LSN poll failed on {replica_config.host}, falling back to row poll: {e}")
+                replica_conn.rollback()
+                use_row_poll = True
+
+        if not use_row_poll:
+            return None  # Timed out waiting for WAL replay
+
+        # Prepare the poll query once per connection so each tick only pays
+        # a parameter bind instead of a full parse/plan
+        if id(replica_conn) not in self._prepared_conns:
+            with replica_conn.cursor() as cur:
+                cur.execute("""
+                    PREPARE replication_poll(text) AS
+                    SELECT created_at FROM replication_test WHERE test_data = $1
+                """)
+            self._prepared_conns.add(id(replica_conn))
+
+        if id(replica_conn) not in self._listen_attempted:
+            self._listen_attempted.add(id(replica_conn))
+            self._start_listening(replica_conn)
+        listening = id(replica_conn) in self._listening_conns
+
+        # One cursor for the whole poll loop instead of an open/close per tick
+        cur = replica_conn.cursor()
+        try:
+            while time.time() - start_time < timeout:
+                try:
+                    if listening:
+                        # Block on the socket until the replica delivers a
+                        # notification (or the poll interval elapses), then
+                        # drain and match payloads against our UUID
+                        select.select([replica_conn], [], [], 0.05)
+                        replica_conn.poll()
+                        while replica_conn.notifies:
+                            notify = replica_conn.notifies.pop(0)
+                            if notify.payload == target_uuid:
+                                return time.time()
+
                     # Using the table created by test_replication.py
                     # We look for the UUID in test_data
-                    cur.execute("SELECT created_at FROM replication_test WHERE test_data = %s", (target_uuid,))
+                    cur.execute("EXECUTE replication_poll(%s)", (target_uuid,))
                     result = cur.fetchone()
-                    
+
                     if result:
                         # Found it!
                         # We return the wall-clock time elapsed since we started polling
                         # Note: This includes network round trip, processing time, etc.
                         return time.time()
-                
-                # Short sleep to avoid hammering the DB
-                time.sleep(0.05) 
-                
-            except Exception as e:
-                print(f"Error polling {replica_config.host}: {e}")
-                # Try to reconnect if connection lost? For now just fail this poll.
-                return None
-                
-        return None  # Timed out
+
+                    if not listening:
+                        # Short sleep to avoid hammering the DB
+                        time.sleep(0.05)
+
+                except Exception as e:
+                    print(f"Error polling {replica_config.host}: {e}")
+                    # Try to reconnect if connection lost? For now just fail this poll.
+                    return None
+
+            return None  # Timed out
+        finally:
+            cur.close()
 
     def measure_replication_lag(self) -> Dict[str, float]:
         """
@@ -101,13 +233,18 @@ class ReplicationRateVerifier:
         
         # Insert into primary
         insert_time = time.time()
+        target_lsn = None
         try:
-            with self.primary_conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO replication_test (test_data, random_value)
-                    VALUES (%s, %s)
-                """, (test_uuid, 0))
-                self.primary_conn.commit()
+            self._primary_cur.execute("""
+                INSERT INTO replication_test (test_data, random_value)
+                VALUES (%s, %s)
+            """, (test_uuid, 0))
+            self.primary_conn.commit()
+            # Capture the WAL position of the committed insert so the
+            # replicas can be tracked by replayed bytes, not by row polls
+            self._primary_cur.execute("SELECT pg_current_wal_insert_lsn()")
+            target_lsn = self._primary_cur.fetchone()[0]
+            self.primary_conn.commit()
         except Exception as e:
             self.primary_conn.rollback()
             print(f"Error inserting validation record: {e}")
@@ -115,8 +252,8 @@ class ReplicationRateVerifier:
 
         # Poll replicas concurrently
         lags = {}
-        with ThreadPoolExecutor(max_workers=len(self.replica_conns)) as executor:
-            future_to_host = {executor.submit(self._wait_for_replica, config, conn, test_uuid): config.host for config, conn in self.replica_conns}
+        with ThreadPoolExecutor(max_workers=len(self.replica_pools)) as executor:
+            future_to_host = {executor.submit(self._wait_for_replica, config, pool, test_uuid, target_lsn): config.host for config, pool in self.replica_pools}
             
             for future in as_completed(future_to_host):
                 host = future_to_host[future]
@@ -161,7 +298,12 @@ class ReplicationRateVerifier:
             avg_lag = statistics.mean(lags)
             min_lag = min(lags)
             max_lag = max(lags)
-            p95_lag = sorted(lags)[int(len(lags) * 0.95)] if len(lags) > 1 else max_lag
+            # Interpolated 95th percentile; indexing a sorted list
+            # over-reads the tail at small sample counts
+            if len(lags) > 1:
+                p95_lag = statistics.quantiles(lags, n=100, method='inclusive')[94]
+            else:
+                p95_lag = max_lag
             
             print(f"Host: {host}")
             print(f"  Samples: {len(lags)}/{samples}")